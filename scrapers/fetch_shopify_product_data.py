@@ -1,10 +1,32 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import csv
+import gzip
 import time
 import logging
 import os
-from urllib.parse import urlparse, urlunparse
+import functools
+import socket
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlparse, urlunparse
+
+try:
+    # orjson decodes the large /products.json pages much faster than the stdlib
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # Optional incremental parser, only used when STREAM_PARSE is enabled
+    import ijson
+    JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError) # orjson.JSONDecodeError is a subclass of the former
+except ImportError:
+    ijson = None
+    JSON_ERRORS = (json.JSONDecodeError,)
 
 # --- Configuration ---
 # Add the base domains of the Shopify stores here
@@ -24,8 +46,18 @@ STORE_DOMAINS = [
     # Make sure they actually use the /products.json endpoint
 ]
 
-# Output CSV file name
+# Output CSV file name (use a ".gz" suffix, e.g. "products_data.csv.gz", to write gzip-compressed CSV)
 CSV_FILENAME = "products_data.csv"
+WRITE_BUFFER_ROWS = 10_000 # Rows collected from all domains before each batched write...
+WRITE_BUFFER_BYTES = 4 << 20 # ...or estimated CSV bytes, whichever is reached first
+ROW_SIZE_OVERHEAD = 200 # Rough CSV bytes taken by the short columns of a row
+CSV_GZIP_LEVEL = 3 # Fast compression; the text-heavy columns still shrink several times
+
+# Latest product updated_at seen per domain, plus the ids of the products updated at exactly
+# that time. Later runs only ask each store for products updated since then; Shopify's
+# updated_at_min is inclusive, so those boundary products are skipped instead of appended
+# again. Delete the file (or start a new CSV) to force a full crawl.
+STATE_FILENAME = "crawl_state.json"
 
 # Fields to extract for the CSV file
 # Adjust these based on the exact data points you need
@@ -53,12 +85,137 @@ CSV_HEADERS = [
     'all_image_srcs' # All image URLs joined by '|'
 ]
 
+# Where each CSV column's value comes from:
+#   ('product', key) / ('variant', key) -> product.get(key) / variant.get(key)
+#   ('value', name) -> a value computed once per product in flatten_data
+# Headers missing here default to ('product', header).
+CSV_FIELD_SOURCES = {
+    'store_domain': ('value', 'store_domain'),
+    'product_id': ('product', 'id'),
+    'tags': ('value', 'tags_joined'),
+    'variant_id': ('variant', 'id'),
+    'variant_title': ('variant', 'title'),
+    'sku': ('variant', 'sku'),
+    'price': ('variant', 'price'),
+    'compare_at_price': ('variant', 'compare_at_price'),
+    'available': ('variant', 'available'),
+    'variant_created_at': ('variant', 'created_at'),
+    'variant_updated_at': ('variant', 'updated_at'),
+    'image_src': ('value', 'first_image_src'), # Use product's first image for simplicity
+    'all_image_srcs': ('value', 'all_image_srcs'),
+    # Note: variant.featured_image could be used if needed, but requires mapping
+}
+
+# HTTP settings shared by every request
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+REQUEST_TIMEOUT = (5, 30) # (connect, read) timeouts in seconds
+PAGE_DELAY = 0.3 # Starting gap in seconds between two requests to the same store
+MAX_PAGE_DELAY = 30 # Upper bound for the gap after repeated throttling
+RATE_LIMIT_RETRIES = 3 # Times a page is retried after a 429 Too Many Requests
+# Keep-alive connections kept per store. since_id pages are fetched one after another,
+# so a store never has more than one request in flight and one connection is reused.
+CONNECTIONS_PER_HOST = 2
+MAX_CONCURRENT_DOMAINS = 16 # Number of stores fetched in parallel
+PAGE_LIMIT = 250 # Max limit for Shopify's /products.json
+# Parse pages incrementally off the socket with ijson instead of orjson/json. This only saves
+# the raw body buffer (~1 MB per page; the parsed page is still built as a list) and is
+# about 3x slower than orjson, so it is off by default. Needs ijson installed.
+STREAM_PARSE = False
+STREAM_JSON = STREAM_PARSE and ijson is not None
+
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# --- HTTP Session ---
+def create_session():
+    """Creates a requests.Session that keeps connections alive and retries transient errors."""
+    session = requests.Session()
+    session.headers.update(REQUEST_HEADERS) # Add headers to mimic a browser request
+    retries = Retry(
+        total=5,
+        backoff_factor=1.5,
+        status_forcelist=[500, 502, 503, 504], # 429 is handled by RATE_LIMITER
+        allowed_methods=['GET'],
+    )
+    adapter = HTTPAdapter(pool_connections=len(STORE_DOMAINS), pool_maxsize=CONNECTIONS_PER_HOST, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+# Reused for every page of every store so TCP/TLS connections are kept alive
+SESSION = create_session()
+
+# --- Rate Limiting ---
+class HostRateLimiter:
+    """Spaces out requests to the same host, adapting the gap to Shopify's feedback (thread-safe).
+
+    The gap starts at `interval`. It follows the X-Shopify-Shop-Api-Call-Limit header
+    ("current/max") when present, doubles on every 429 response (never waiting less than
+    its Retry-After), and halves back towards the target on successful responses.
+    """
+
+    def __init__(self, interval, max_interval):
+        self.interval = interval
+        self.max_interval = max_interval
+        self._intervals = {}
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """Blocks until the next request to `host` is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_allowed.get(host, now))
+            self._next_allowed[host] = start + self._intervals.get(host, self.interval)
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, host, response):
+        """Adjusts the gap for `host` from a response. Returns True if the request was throttled."""
+        with self._lock:
+            current = self._intervals.get(host, self.interval)
+            if response.status_code == 429:
+                interval = min(self.max_interval, max(current, self.interval) * 2) # Never back off less than the starting gap
+                delay = max(interval, parse_retry_after(response.headers.get('Retry-After')))
+                throttled = True
+            else:
+                target = self.interval
+                call_limit = parse_call_limit(response.headers.get('X-Shopify-Shop-Api-Call-Limit'))
+                if call_limit is not None:
+                    target = self.interval * call_limit
+                interval = delay = max(target, current / 2)
+                throttled = False
+            self._intervals[host] = interval
+            self._next_allowed[host] = time.monotonic() + delay
+        return throttled
+
+def parse_retry_after(value):
+    """Returns the seconds from a Retry-After header, or 0 if it is missing or not a number."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0 # Missing, or an HTTP date (not used by Shopify)
+
+def parse_call_limit(value):
+    """Returns the used fraction of a "current/max" call limit header, or None."""
+    try:
+        current, maximum = value.split('/')
+        return int(current) / int(maximum)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+# Be polite and avoid rate limiting: different stores don't wait on each other
+RATE_LIMITER = HostRateLimiter(PAGE_DELAY, MAX_PAGE_DELAY)
+
 # --- Helper Functions ---
+@functools.lru_cache(maxsize=None)
 def construct_url(domain):
     """Constructs the full https://domain/products.json URL."""
+    if domain and '://' not in domain and '/' not in domain:
+        return f"https://{domain}/products.json" # Bare hostname, nothing to parse
+
     parsed = urlparse(f"//{domain}") # Use // to allow urlparse to work
     if not parsed.scheme:
         scheme = "https" # Default to https
@@ -75,161 +232,408 @@ def construct_url(domain):
     url = urlunparse((scheme, netloc, "/products.json", "", "", ""))
     return url
 
-def fetch_products(url):
-    """Fetches products from a single store's /products.json endpoint."""
-    products = []
-    page = 1
-    limit = 250 # Max limit for Shopify's /products.json
-    while True:
-        paginated_url = f"{url}?limit={limit}&page={page}"
-        logging.info(f"Fetching: {paginated_url}")
-        try:
-            # Add headers to mimic a browser request
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            response = requests.get(paginated_url, timeout=30, headers=headers) # Increased timeout
-            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-            data = response.json()
-
-            if "products" in data and data["products"]:
-                products.extend(data["products"])
-                logging.info(f"Fetched {len(data['products'])} products from page {page}. Total so far: {len(products)}")
-                # If fewer products than the limit are returned, it's the last page
-                if len(data["products"]) < limit:
-                    break
-                page += 1
-            else:
-                logging.info(f"No more products found on page {page} or invalid JSON structure for {url}.")
-                break # No products key or empty list
-
-            # --- Be polite and avoid rate limiting ---
-            time.sleep(1.5) # Wait 1.5 seconds between page requests
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error fetching {paginated_url}: {e}")
-            break # Stop trying for this domain on error
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decoding JSON from {paginated_url}: {e}")
-            logging.error(f"Response text: {response.text[:500]}...") # Log part of the response
-            break # Stop trying for this domain
-        except Exception as e:
-            logging.error(f"An unexpected error occurred for {paginated_url}: {e}")
-            break
-    return products
+def resolve_host(host):
+    """Resolves a store's hostname up front. Returns False if it cannot be resolved.
+
+    This warms the resolver cache before the first request and lets unknown domains
+    fail fast instead of going through every connection retry.
+    """
+    try:
+        socket.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+        return True
+    except (socket.gaierror, UnicodeError) as e:
+        logging.error(f"Could not resolve {host}: {e}")
+        return False
+
+def uses_proxy(url):
+    """Returns True if requests would send `url` through a proxy, which then does the DNS lookup."""
+    proxies = dict(SESSION.proxies)
+    if SESSION.trust_env:
+        proxies.update(requests.utils.get_environ_proxies(url)) # Honors HTTPS_PROXY / NO_PROXY
+    return requests.utils.select_proxy(url, proxies) is not None
+
+def parse_products(response):
+    """Returns the list of products in a /products.json response."""
+    if STREAM_JSON:
+        # The raw body is never held in memory as a whole
+        response.raw.decode_content = True # Let urllib3 undo gzip/deflate
+        return list(ijson.items(response.raw, 'products.item', use_float=True))
+
+    data = json_loads(response.content)
+    if "products" in data and data["products"]:
+        return data["products"]
+    return [] # No products key or empty list
+
+class FetchError(Exception):
+    """Raised when a store's products could not all be fetched."""
+
+def fetch_page(url, host, query):
+    """Fetches one page of products. Returns an empty list when there are no more products, None on error."""
+    paginated_url = f"{url}?limit={PAGE_LIMIT}&{query}"
+    logging.info(f"Fetching: {paginated_url}")
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            RATE_LIMITER.wait(host)
+            with SESSION.get(paginated_url, timeout=REQUEST_TIMEOUT, stream=STREAM_JSON) as response:
+                if RATE_LIMITER.update(host, response) and attempt < RATE_LIMIT_RETRIES:
+                    logging.warning(f"Rate limited by {host}. Retrying {paginated_url}")
+                    continue
+                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+                products = parse_products(response)
+
+            if products:
+                return products
+            logging.info(f"No more products found at {paginated_url} or invalid JSON structure.")
+            return []
+
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error fetching {paginated_url}: {e}")
+    except JSON_ERRORS as e:
+        logging.error(f"Error decoding JSON from {paginated_url}: {e}")
+        if not STREAM_JSON and logging.getLogger().isEnabledFor(logging.ERROR): # A streamed body has already been consumed
+            # Only the logged prefix is decoded, not the whole (possibly large) body
+            logging.error(f"Response text: {response.content[:500].decode('utf-8', 'replace')}...")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred for {paginated_url}: {e}")
+    return None # Stop trying for this domain on error
+
+def fetch_products(url, updated_at_min=None):
+    """Yields pages of products from a single store's /products.json endpoint.
+
+    Pages are walked with the since_id cursor, and the next page is requested in a
+    background thread while the caller processes the current one. With `updated_at_min`,
+    only products updated since then are requested. Raises FetchError if a page fails.
+    """
+    host = urlparse(url).netloc
+    filters = f"&updated_at_min={quote(updated_at_min, safe='')}" if updated_at_min else ""
+    total = 0
+    since_id = 0
+    page = None # Only used if the store ignores since_id
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(fetch_page, url, host, "since_id=0" + filters)
+        while pending is not None:
+            products = pending.result()
+            pending = None
+            if products is None:
+                raise FetchError(f"Stopped fetching {host} after {total} products")
+            if not products:
+                break
+
+            if page is None and since_id and products[0].get('id', 0) <= since_id:
+                # The cursor was ignored and the first page came back again
+                logging.warning(f"{host} ignores since_id. Falling back to page-based pagination.")
+                page = 2
+                pending = prefetcher.submit(fetch_page, url, host, f"page={page}" + filters)
+                continue
+
+            # If fewer products than the limit are returned, it's the last page
+            if len(products) == PAGE_LIMIT:
+                if page is None:
+                    since_id = max(product.get('id', 0) for product in products)
+                    query = f"since_id={since_id}"
+                else:
+                    page += 1
+                    query = f"page={page}"
+                pending = prefetcher.submit(fetch_page, url, host, query + filters)
+
+            total += len(products)
+            logging.info(f"Fetched {len(products)} products from {host}. Total so far: {total}")
+            yield products
+
+# Per-product values a ('value', name) column can use: the parameters of build_rows besides product
+ROW_VALUE_NAMES = ('store_domain', 'tags_joined', 'first_image_src', 'all_image_srcs')
+
+def compile_row_builder(headers, sources):
+    """Generates build_rows(store_domain, product, tags_joined, first_image_src, all_image_srcs).
+
+    The generated function returns the rows of one product (one per variant) as tuples
+    in `headers` order. Product-level values are read once into locals, so each variant
+    row is a single tuple built from locals and variant.get() calls.
+    """
+    product_lines = []
+    product_values = []
+    variant_values = []
+    for i, header in enumerate(headers):
+        kind, name = sources.get(header, ('product', header))
+        if kind == 'product':
+            product_lines.append(f"    p{i} = g({name!r})")
+            product_values.append(f"p{i}")
+            variant_values.append(f"p{i}")
+        elif kind == 'variant':
+            product_values.append("None")
+            variant_values.append(f"vg({name!r})")
+        elif kind == 'value':
+            if name not in ROW_VALUE_NAMES:
+                raise ValueError(f"Unknown value {name!r} for CSV column {header!r}")
+            product_values.append(name)
+            variant_values.append(name)
+        else:
+            raise ValueError(f"Unknown source {kind!r} for CSV column {header!r}")
+
+    source = "\n".join([
+        "def build_rows(store_domain, product, tags_joined, first_image_src, all_image_srcs):",
+        "    g = product.get",
+        *product_lines,
+        "    variants = g('variants')",
+        "    if not variants:",
+        "        # Handle products with no variants (though rare for standard Shopify setups)",
+        f"        return [({', '.join(product_values)},)]",
+        "    rows = []",
+        "    append = rows.append",
+        "    for variant in variants:",
+        "        vg = variant.get",
+        f"        append(({', '.join(variant_values)},))",
+        "    return rows",
+    ])
+    namespace = {}
+    exec(compile(source, "<build_rows>", "exec"), namespace)
+    return namespace['build_rows']
+
+# Specialized once for the configured columns
+build_rows = compile_row_builder(CSV_HEADERS, CSV_FIELD_SOURCES)
 
 def flatten_data(all_products_data, store_domain):
-    """Flattens the product and variant data for CSV writing."""
-    flattened_rows = []
+    """Flattens the product and variant data for CSV writing.
+
+    Returns (rows, estimated_bytes): one tuple per variant, with values in CSV_HEADERS
+    order, and a rough size of those rows once written as CSV.
+    """
+    rows = []
+    estimated_bytes = 0
     for product in all_products_data:
-        product_id = product.get('id')
-        first_image_src = product.get('images', [{}])[0].get('src') if product.get('images') else None
-        all_image_srcs = '|'.join([img.get('src', '') for img in product.get('images', []) if img.get('src')])
-
-        if not product.get('variants'):
-            # Handle products with no variants (though rare for standard Shopify setups)
-             row = {
-                'store_domain': store_domain,
-                'product_id': product_id,
-                'title': product.get('title'),
-                'handle': product.get('handle'),
-                'vendor': product.get('vendor'),
-                'product_type': product.get('product_type'),
-                'created_at': product.get('created_at'),
-                'updated_at': product.get('updated_at'),
-                'published_at': product.get('published_at'),
-                'tags': ', '.join(product.get('tags', [])),
-                'body_html': product.get('body_html'),
-                'variant_id': None,
-                'variant_title': None,
-                'sku': None,
-                'price': None,
-                'compare_at_price': None,
-                'available': None,
-                'variant_created_at': None,
-                'variant_updated_at': None,
-                'image_src': first_image_src,
-                'all_image_srcs': all_image_srcs,
-            }
-             flattened_rows.append(row)
-        else:
-            # Create a row for each variant
-            for variant in product.get('variants', []):
-                row = {
-                    'store_domain': store_domain,
-                    'product_id': product_id,
-                    'title': product.get('title'),
-                    'handle': product.get('handle'),
-                    'vendor': product.get('vendor'),
-                    'product_type': product.get('product_type'),
-                    'created_at': product.get('created_at'), # Product created_at
-                    'updated_at': product.get('updated_at'), # Product updated_at
-                    'published_at': product.get('published_at'),
-                    'tags': ', '.join(product.get('tags', [])),
-                    'body_html': product.get('body_html'),
-                    'variant_id': variant.get('id'),
-                    'variant_title': variant.get('title'),
-                    'sku': variant.get('sku'),
-                    'price': variant.get('price'),
-                    'compare_at_price': variant.get('compare_at_price'),
-                    'available': variant.get('available'),
-                    'variant_created_at': variant.get('created_at'), # Variant created_at
-                    'variant_updated_at': variant.get('updated_at'), # Variant updated_at
-                    'image_src': first_image_src, # Use product's first image for simplicity
-                    'all_image_srcs': all_image_srcs,
-                    # Note: variant.featured_image could be used if needed, but requires mapping
-                }
-                flattened_rows.append(row)
-    return flattened_rows
-
-def save_to_csv(data, filename, headers):
-    """Saves the flattened data to a CSV file."""
-    file_exists = os.path.isfile(filename)
+        images = product.get('images') or ()
+        first_image_src = images[0].get('src') if images else None
+        all_image_srcs = '|'.join([src for src in (img.get('src') for img in images) if src])
+        tags_joined = ', '.join(product.get('tags') or ())
+
+        product_rows = build_rows(store_domain, product, tags_joined, first_image_src, all_image_srcs)
+        rows.extend(product_rows)
+        # The long product-level strings dominate the size and are repeated on every variant row
+        long_fields = len(product.get('body_html') or '') + len(all_image_srcs) + len(tags_joined)
+        estimated_bytes += len(product_rows) * (ROW_SIZE_OVERHEAD + long_fields)
+    return rows, estimated_bytes
+
+class BufferedRowWriter:
+    """Thread-safe csv writer that batches the rows of all domains into large writerows() calls."""
+
+    def __init__(self, csvfile, max_rows=WRITE_BUFFER_ROWS, max_bytes=WRITE_BUFFER_BYTES):
+        self._writer = csv.writer(csvfile)
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+
+    def writerow(self, row):
+        """Writes a single row (e.g. the header) immediately."""
+        with self._lock:
+            self._writer.writerow(row)
+
+    def writerows(self, rows, estimated_bytes=0):
+        """Buffers rows, writing them out once `max_rows` or `max_bytes` have accumulated."""
+        with self._lock:
+            self._buffer.extend(rows)
+            self._buffer_bytes += estimated_bytes
+            if len(self._buffer) >= self._max_rows or self._buffer_bytes >= self._max_bytes:
+                self._flush_locked()
+
+    def flush(self):
+        """Writes out any buffered rows."""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._buffer:
+            self._writer.writerows(self._buffer)
+            self._buffer.clear()
+        self._buffer_bytes = 0
+
+def open_csv(filename):
+    """Opens the output CSV for appending, gzip-compressed if the name ends with .gz."""
+    if filename.endswith('.gz'):
+        # Appending adds a new gzip member, which gzip readers decode transparently
+        return gzip.open(filename, 'at', newline='', encoding='utf-8', compresslevel=CSV_GZIP_LEVEL)
+    return open(filename, 'a', newline='', encoding='utf-8', buffering=1 << 20)
+
+# --- Resume State ---
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp, treating naive values as UTC. Returns None if it is invalid."""
+    if isinstance(value, str) and value.endswith('Z'):
+        value = value[:-1] + '+00:00' # fromisoformat only accepts "Z" from Python 3.11
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def is_valid_checkpoint(checkpoint):
+    """Returns True if a loaded checkpoint has a valid timestamp and a list of int/str product ids."""
+    if not isinstance(checkpoint, dict) or parse_timestamp(checkpoint.get('updated_at')) is None:
+        return False
+    product_ids = checkpoint.get('product_ids', [])
+    return isinstance(product_ids, list) and all(
+        isinstance(product_id, (int, str)) and not isinstance(product_id, bool) for product_id in product_ids
+    )
+
+def load_state(filename):
+    """Loads the {domain: checkpoint} resume state, or {} if there is none.
+
+    A checkpoint is {'updated_at': ISO 8601 string, 'product_ids': [...]}. Entries with a
+    timestamp that can't be parsed are dropped, so those domains get a full crawl.
+    """
+    try:
+        with open(filename, encoding='utf-8') as f:
+            raw_state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (IOError, ValueError) as e:
+        logging.error(f"Could not read {filename}, doing a full crawl: {e}")
+        return {}
+    if not isinstance(raw_state, dict):
+        logging.error(f"Unexpected content in {filename}, doing a full crawl.")
+        return {}
+
+    state = {}
+    for domain, checkpoint in raw_state.items():
+        if isinstance(checkpoint, str): # Older files stored only the timestamp
+            checkpoint = {'updated_at': checkpoint, 'product_ids': []}
+        if not is_valid_checkpoint(checkpoint):
+            logging.warning(f"Ignoring invalid resume state for {domain}, doing a full crawl.")
+            continue
+        state[domain] = {'updated_at': checkpoint['updated_at'], 'product_ids': checkpoint.get('product_ids', [])}
+    return state
+
+def save_state(state, filename):
+    """Writes the resume state, replacing the previous file only once it is complete."""
+    temp_filename = f"{filename}.tmp"
     try:
-        with open(filename, 'a', newline='', encoding='utf-8') as csvfile: # Use 'a' to append
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            if not file_exists or os.path.getsize(filename) == 0:
-                 writer.writeheader() # Write header only if file is new or empty
-            writer.writerows(data)
-        logging.info(f"Successfully appended {len(data)} rows to {filename}")
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(temp_filename, filename)
     except IOError as e:
-        logging.error(f"Error writing to CSV file {filename}: {e}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during CSV writing: {e}")
+        logging.error(f"Error writing state file {filename}: {e}")
+
+def advance_checkpoint(checkpoint, products):
+    """Returns `checkpoint` moved forward to the most recent updated_at among `products`.
+
+    Products whose updated_at is missing or invalid are ignored. Returns None if no
+    timestamp has been seen at all.
+    """
+    if checkpoint:
+        latest_raw = checkpoint['updated_at']
+        latest = parse_timestamp(latest_raw)
+        ids = set(checkpoint['product_ids'])
+    else:
+        latest_raw = latest = None
+        ids = set()
+
+    for product in products:
+        updated_at = parse_timestamp(product.get('updated_at'))
+        if updated_at is None:
+            continue
+        if latest is None or updated_at > latest:
+            latest_raw, latest, ids = product['updated_at'], updated_at, {product.get('id')}
+        elif updated_at == latest:
+            ids.add(product.get('id'))
+
+    if latest is None:
+        return None
+    ids.discard(None)
+    return {'updated_at': latest_raw, 'product_ids': sorted(ids, key=str)}
+
+def process_domain(domain, writer, checkpoint=None):
+    """Fetches the products of one store and hands their rows to `writer` as each page arrives.
+
+    With a resume `checkpoint`, only products updated since then are fetched. Returns
+    (product_count, new_checkpoint). new_checkpoint is None if the crawl stopped early,
+    so the resume state is only advanced after a full crawl.
+    """
+    logging.info(f"--- Processing domain: {domain} ---")
+    url = construct_url(domain)
+    if not url:
+        return 0, None
+    # Behind a proxy the local resolver may not see public hosts, so leave the lookup to the proxy
+    if not uses_proxy(url) and not resolve_host(urlparse(url).hostname):
+        return 0, None
+
+    updated_at_min = checkpoint['updated_at'] if checkpoint else None
+    boundary = parse_timestamp(updated_at_min)
+    boundary_ids = set(checkpoint['product_ids']) if checkpoint else set()
+    product_count = 0
+    try:
+        for products in fetch_products(url, updated_at_min):
+            if boundary_ids:
+                # updated_at_min is inclusive: skip the products already written last run
+                products = [
+                    product for product in products
+                    if product.get('id') not in boundary_ids or parse_timestamp(product.get('updated_at')) != boundary
+                ]
+            checkpoint = advance_checkpoint(checkpoint, products)
+            if not products:
+                continue
+            # Flattened while the next page is being downloaded
+            rows, estimated_bytes = flatten_data(products, domain) # Flattened outside the writer's lock
+            writer.writerows(rows, estimated_bytes)
+            product_count += len(products)
+    except FetchError as e:
+        logging.warning(f"{e}. Resume state for {domain} is left unchanged.")
+        return product_count, None
+    return product_count, checkpoint
 
 # --- Main Execution ---
 if __name__ == "__main__":
-    all_flattened_data = []
-
     # Clear the file before starting if you want fresh data each time
-    # Or handle appending logic carefully (as done in save_to_csv)
-    if os.path.exists(CSV_FILENAME):
+    # Or handle appending logic carefully (the header is only written to a new or empty file)
+    write_header = not os.path.isfile(CSV_FILENAME) or os.path.getsize(CSV_FILENAME) == 0
+    if not write_header:
          logging.warning(f"{CSV_FILENAME} exists. Appending data. Delete the file manually for a fresh start.")
          # Optional: uncomment to delete the file before running
          # os.remove(CSV_FILENAME)
          # logging.info(f"Removed existing {CSV_FILENAME}.")
+         # write_header = True
 
+    # A new CSV needs every product, so the resume state only applies when appending
+    state = load_state(STATE_FILENAME) if not write_header else {}
+    try:
+        # A single buffered file handle and writer are shared by all domains
+        with open_csv(CSV_FILENAME) as csvfile: # Appends to an existing file
+            writer = BufferedRowWriter(csvfile)
+            if write_header:
+                writer.writerow(CSV_HEADERS)
 
-    for domain in STORE_DOMAINS:
-        logging.info(f"--- Processing domain: {domain} ---")
-        url = construct_url(domain)
-        if not url:
-            continue
-
-        products_data = fetch_products(url)
-
-        if products_data:
-            logging.info(f"Fetched a total of {len(products_data)} product entries for {domain}.")
-            flattened = flatten_data(products_data, domain)
-            if flattened:
-                save_to_csv(flattened, CSV_FILENAME, CSV_HEADERS)
-            else:
-                logging.warning(f"No data flattened for {domain}.")
-        else:
-            logging.warning(f"No products retrieved for {domain}.")
-
-        # Add a small delay between different domains
-        time.sleep(2)
+            # Each store is fetched in its own thread, sharing SESSION's connection pool
+            max_workers = max(1, min(MAX_CONCURRENT_DOMAINS, len(STORE_DOMAINS)))
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(process_domain, domain, writer, state.get(domain)): domain
+                        for domain in STORE_DOMAINS
+                    }
+                    for future in as_completed(futures):
+                        domain = futures[future]
+                        try:
+                            product_count, checkpoint = future.result()
+                        except IOError:
+                            raise # The CSV can't be written, so no other store can succeed either
+                        except Exception as e:
+                            # One failing store keeps its previous resume state and doesn't stop the others
+                            logging.error(f"An unexpected error occurred for {domain}: {e}")
+                            continue
+                        if checkpoint:
+                            state[domain] = checkpoint
+                        if product_count:
+                            logging.info(f"Fetched {product_count} product entries for {domain}.")
+                        elif state.get(domain):
+                            logging.info(f"No products updated since {state[domain]['updated_at']} for {domain}.")
+                        else:
+                            logging.warning(f"No products retrieved for {domain}.")
+            finally:
+                writer.flush() # Write out the rows still buffered
+        logging.info(f"Successfully appended all rows to {CSV_FILENAME}")
+        save_state(state, STATE_FILENAME) # Only once the rows are safely written
+    except IOError as e:
+        logging.error(f"Error writing to CSV file {CSV_FILENAME}: {e}")
+    finally:
+        SESSION.close()
 
     logging.info("--- Data fetching complete. ---")
\ No newline at end of file